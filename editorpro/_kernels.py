@@ -0,0 +1,52 @@
+import numpy as np
+
+# numba is optional, without it the numpy version is used
+try:
+    from numba import njit
+
+except ImportError:
+    njit = None
+
+def _visible_area(frame: np.ndarray[np.uint8], stamp: np.ndarray[np.uint8], x: int, y: int) -> tuple[int, int, int, int]:
+    h, w = stamp.shape[:2]
+    frame_h, frame_w = frame.shape[:2]
+
+    return max(x, 0), max(y, 0), min(x + w, frame_w), min(y + h, frame_h)
+
+def _alpha_blit_numpy(frame: np.ndarray[np.uint8], stamp: np.ndarray[np.uint8], x: int, y: int) -> None:
+    x0, y0, x1, y1 = _visible_area(frame, stamp, x, y)
+
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    src = stamp[y0 - y:y1 - y, x0 - x:x1 - x]
+    dst = frame[y0:y1, x0:x1]
+    alpha = src[..., 3:].astype(np.uint16)
+
+    dst[:] = (src[..., :3] * alpha + dst * (255 - alpha) + 127) // 255
+
+if njit is not None:
+    # No parallel=True, frames are already drawn from multiple threads
+    @njit(nogil=True, fastmath=True, cache=True)
+    def alpha_blit(frame: np.ndarray[np.uint8], stamp: np.ndarray[np.uint8], x: int, y: int) -> None:
+        h, w = stamp.shape[:2]
+        frame_h, frame_w = frame.shape[:2]
+
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, frame_w), min(y + h, frame_h)
+
+        for j in range(y0, y1):
+            for i in range(x0, x1):
+                a = np.uint16(stamp[j - y, i - x, 3])
+
+                if a == 0:
+                    continue
+
+                for c in range(3):
+                    frame[j, i, c] = np.uint8((stamp[j - y, i - x, c] * a + frame[j, i, c] * (255 - a) + 127) // 255)
+
+    # Compile on import, so the first frame doesn't pay for it
+    alpha_blit(np.zeros((1, 1, 3), dtype=np.uint8), np.zeros((1, 1, 4), dtype=np.uint8), 0, 0)
+
+else:
+    alpha_blit = _alpha_blit_numpy
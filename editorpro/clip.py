@@ -3,8 +3,9 @@ from typing import overload, Union, Literal, Type
 import tempfile
 import subprocess
 from .utils import *
-from mutagen.mp3 import MP3
+from .frame import Frame
 import os
+import functools
 import numpy as np
 
 class Clip:
@@ -15,6 +16,29 @@ class Clip:
     def cleanup(self) -> None:
         pass
 
+def _probe_duration(path: str, entries: str, stream: str = None) -> str:
+    return subprocess.run([
+        'ffprobe',
+        '-v', 'error',
+        *(['-select_streams', stream] if stream is not None else []),
+        '-show_entries', entries,
+        '-of', 'csv=p=0',
+        path
+    ], capture_output=True, text=True).stdout.strip()
+
+@functools.lru_cache
+def _mp3_duration(path: str) -> float:
+    output = _probe_duration(path, 'format=duration')
+
+    # Container doesn't store its duration, try the audio stream
+    if output in ("", "N/A"):
+        output = _probe_duration(path, 'stream=duration', 'a:0')
+
+    if output in ("", "N/A"):
+        raise ValueError(f"Couldn't read the duration of {path}.")
+
+    return float(output)
+
 class AudioClip(Clip):
     @overload
     def __init__(self, clip: 'VideoClip'): ...
@@ -27,55 +51,50 @@ class AudioClip(Clip):
 
     @checktypes(None, (str, Clip, bytes), allow_none=True)
     def __init__(self, data: Union[str, 'VideoClip', bytes]):
+        self.audio_stream = 0
+
         if data is None:
             super().__init__(0)
             return
 
-        if isinstance(data, str):
-            self.file = data
-
-            if not os.path.exists(self.file):
-                raise FileNotFoundError(f"File {self.file} does not exist.")
-            
-        else:
-            self.file = tempfile.mktemp() + ".mp3"
-            self.tempfile = True
-
         if isinstance(data, VideoClip):
-            # TODO: FIX: For each audio in subclip of VideoClip it creates a new file
-            subprocess.run([
-                'ffmpeg',
-                '-i', data.file,
-                '-vn',
-                # '-c:a', 'copy', # Can't copy?
-                self.file
-            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            # The audio is read straight from the video file when exporting
+            self.file = data.file
+            self.tempfile = False
 
             super().__init__(
-                duration=data.duration,
+                duration=max(0, min(data.duration, data.audio_duration - data.start)),
                 start=data.start
             )
 
             return
-        
+
+        if isinstance(data, str):
+            self.file = data
+
+            if not os.path.exists(self.file):
+                raise FileNotFoundError(f"File {self.file} does not exist.")
+            
         elif isinstance(data, bytes):
-            with open(self.file, "wb") as f:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as f:
                 f.write(data)
-        
-        self.info = MP3(self.file)
+
+            self.file = f.name
+            self.tempfile = True
         
         super().__init__(
-            duration=self.info.info.length
+            duration=_mp3_duration(self.file)
         )
 
     def cleanup(self):
-        if getattr(self, 'tempfile', None) is not None:
+        if getattr(self, 'tempfile', False):
             os.remove(self.file)
 
     def copy(self) -> 'AudioClip':
-        audio = AudioClip()
+        audio = AudioClip(None)
 
         audio.file = self.file
+        audio.audio_stream = self.audio_stream
         audio.duration = self.duration
         audio.start = self.start
 
@@ -99,6 +118,8 @@ class VideoClip(Clip):
     @checktypes(None, (str, bytes), allow_none=True)
     def __init__(self, data: str | bytes):
         self._audio: AudioClip = None
+        self._audio_duration: float = None
+        self._buf: np.ndarray[np.uint8] = None
         
         if data is None:
             super().__init__(0)
@@ -111,13 +132,15 @@ class VideoClip(Clip):
                 raise FileNotFoundError(f"File {self.file} does not exist.")
 
         elif isinstance(data, bytes):
-            self.file = tempfile.mktemp() + ".mp4"
-            self.tempfile = True
-
-            with open(self.file, "wb") as f:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as f:
                 f.write(data)
 
+            self.file = f.name
+            self.tempfile = True
+
         self.cap = cv2.VideoCapture(self.file)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self.position = 0
         
         if not self.cap.isOpened():
             raise ValueError(f"Error opening {self.file}.")
@@ -137,6 +160,24 @@ class VideoClip(Clip):
             self._audio = AudioClip(self)
         
         return self._audio
+
+    @property
+    def audio_duration(self) -> float:
+        if self._audio_duration is None:
+            output = _probe_duration(self.file, 'stream=duration', 'a:0')
+
+            if output == "":
+                # No audio stream
+                self._audio_duration = 0
+
+            elif output == "N/A":
+                # Container doesn't store stream durations, use the length of the whole video
+                self._audio_duration = self.cap.get(cv2.CAP_PROP_FRAME_COUNT) / self.fps
+
+            else:
+                self._audio_duration = float(output)
+
+        return self._audio_duration
     
     def copy(self) -> 'VideoClip':
         video = VideoClip(None)
@@ -146,7 +187,10 @@ class VideoClip(Clip):
         video.resolution = self.resolution
         video.duration = self.duration
         video.start = self.start
+        video._audio_duration = self._audio_duration
         video.cap = cv2.VideoCapture(self.file)
+        video.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        video.position = 0
         
         return video
 
@@ -168,21 +212,74 @@ class VideoClip(Clip):
         video.start = start
         video.duration = end - start
 
-        video.cap.set(cv2.CAP_PROP_POS_FRAMES, int(start * video.fps))
+        video.position = int(start * video.fps)
+        video.cap.set(cv2.CAP_PROP_POS_FRAMES, video.position)
 
         return video
 
     def cleanup(self):
-        if getattr(self, 'tempfile', None) is not None:
+        if getattr(self, 'tempfile', False):
             os.remove(self.file)
 
-    def render(self, frame: np.ndarray[np.uint8], t: int) -> np.ndarray[np.uint8]:
-        ret, frame_ = self.cap.read()
+    def advance_to(self, frame_idx: int) -> bool:
+        # Seeking backwards (same clip rendered twice) is the only case that needs to reset the capture
+        if frame_idx < self.position - 1:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+            self.position = frame_idx
 
-        if not ret:
-            return frame
-        
-        return frame_
+        # Skipped frames are only grabbed, without decoding them
+        while self.position <= frame_idx:
+            if not self.cap.grab():
+                return False
+
+            self.position += 1
+
+        return True
+
+    def retrieve(self, frame: np.ndarray[np.uint8]) -> bool:
+        w, h = self.resolution
+
+        # Decodes straight into the given buffer, different resolutions go to the clip's own buffer
+        if frame.shape[:2] == (h, w):
+            target = frame
+
+        else:
+            if self._buf is None:
+                self._buf = np.empty((h, w, 3), dtype=np.uint8)
+
+            target = self._buf
+
+        ret, image = self.cap.retrieve(target)
+
+        if not ret or image is None:
+            return False
+
+        if np.shares_memory(image, frame):
+            return True
+
+        # OpenCV may reallocate instead of decoding in place (other channels or shape)
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+        elif image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+
+        # Copy the overlapping part
+        h = min(image.shape[0], frame.shape[0])
+        w = min(image.shape[1], frame.shape[1])
+
+        frame.fill(0)
+        frame[:h, :w] = image[:h, :w]
+
+        return True
+
+    def render(self, frame: Frame, t: int | float) -> Frame:
+        # t is the time in seconds since the start of the clip
+        return frame.then("decode", self, int(self.start * self.fps) + round(t * self.fps))
+
+@functools.lru_cache(maxsize=4096)
+def _text_size(text: str, scale: float, thickness: int) -> tuple[tuple[int, int], int]:
+    return cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
 
 Position = Union[
     Literal["top-left"],
@@ -223,40 +320,36 @@ class TextClip(Clip):
 
         w, h = sequence.resolution
         
-        (self.text_w, self.text_h), baseline = cv2.getTextSize(
-            text,
-            cv2.FONT_HERSHEY_SIMPLEX,
-            scale,
-            line_thickness
-        )
+        (self.text_w, self.text_h), baseline = _text_size(text, scale, line_thickness)
 
         self.is_multiline = self.text_w > w
-        if self.text_w > w:
+        text_w, text_h = self.text_w, self.text_h
+
+        if self.is_multiline:
             words = text.split(" ")
-            
+            widths = [_text_size(word, scale, line_thickness)[0][0] for word in words]
+            space = _text_size(" ", scale, line_thickness)[0][0]
+
+            # Greedy fill, a word wider than the frame still gets its own line
             self.blocks = []
-            current = ""
-            current_size = 0
-
-            for word in words:
-                (text_w, text_h), baseline = cv2.getTextSize(
-                    word,
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    scale,
-                    line_thickness
-                )
+            block_widths = []
+            first = 0
+            current_size = widths[0]
 
-                if text_w + current_size < w:
-                    current_size += text_w
-                    current += word + " "
+            for i in range(1, len(words)):
+                if current_size + space + widths[i] <= w:
+                    current_size += space + widths[i]
 
                 else:
-                    self.blocks.append(current)
-                    current = word + " "
-                    current_size = text_w
+                    self.blocks.append(" ".join(words[first:i]))
+                    block_widths.append(current_size)
+                    first = i
+                    current_size = widths[i]
+
+            self.blocks.append(" ".join(words[first:]))
+            block_widths.append(current_size)
 
-            if current != "":
-                self.blocks.append(current)
+            text_w = max(block_widths)
 
         match position:
             case "top-left":
@@ -280,50 +373,67 @@ class TextClip(Clip):
             case (x, y):
                 self.org = (x, y)
 
+        if not self.is_multiline:
+            self.blocks = [text]
+
+        # Frame invariant, computed once instead of every render
+        self.block_positions = [
+            (self.org[0], self.org[1] + self.text_h * i)
+            for i in range(len(self.blocks))
+        ]
+
+        # Each block is rasterized only once, rendering just blends the stamps.
+        # Stroke and fill are separate stamps, layered like the two putText calls they replace
+        self.stamps = []
+        self.stamp_positions = []
+
+        for block, (x, y) in zip(self.blocks, self.block_positions):
+            layers = [(self.color, self.line_thickness)]
+
+            if self.has_stroke:
+                layers.insert(0, (self.stroke_color, self.line_thickness + self.stroke_width))
+
+            for color, thickness in layers:
+                stamp, (offset_x, offset_y) = self.draw_text(block, color, thickness)
+
+                self.stamps.append(stamp)
+                self.stamp_positions.append((x - offset_x, y - offset_y))
+
     def draw_text(
         self,
-        frame,
-        text,       
-        org
-    ) -> None:
-        if self.has_stroke:
-            cv2.putText(
-                frame,
-                text,
-                org,
-                cv2.FONT_HERSHEY_SIMPLEX,
-                self.scale,
-                self.stroke_color,
-                self.line_thickness + self.stroke_width,
-                cv2.LINE_AA,
-                False
-            )
-        
+        text: str,
+        color: tuple[int, int, int],
+        thickness: int
+    ) -> tuple[np.ndarray[np.uint8], tuple[int, int]]:
+        (text_w, text_h), baseline = _text_size(text, self.scale, thickness)
+
+        # Room for the anti-aliased edges
+        pad = thickness
+        org = (pad, pad + text_h)
+
+        size = (text_h + baseline + 2 * pad, text_w + 2 * pad)
+
+        # Single color BGRA stamp, the text only lives in the alpha channel
+        alpha = np.zeros(size, dtype=np.uint8)
+
         cv2.putText(
-            frame,
+            alpha,
             text,
             org,
             cv2.FONT_HERSHEY_SIMPLEX,
             self.scale,
-            self.color,
-            self.line_thickness,
+            255,
+            thickness,
             cv2.LINE_AA,
             False
         )
 
-    def render(self, frame: np.ndarray[np.uint8], t: int) -> np.ndarray[np.uint8]:
-        if self.is_multiline:
-            for block in self.blocks:
-                self.draw_text(
-                    frame,
-                    block,
-                    (
-                        self.org[0],
-                        self.org[1] + self.text_h * self.blocks.index(block)
-                    )
-                )
+        stamp = np.dstack((np.full((*size, 3), color, dtype=np.uint8), alpha))
 
-        else:
-            self.draw_text(frame, self.text, self.org)
+        return stamp, org
+
+    def render(self, frame: Frame, t: int | float) -> Frame:
+        for stamp, position in zip(self.stamps, self.stamp_positions):
+            frame = frame.then("stamp", stamp, position)
 
         return frame
\ No newline at end of file
@@ -0,0 +1,44 @@
+import numpy as np
+from ._kernels import alpha_blit
+
+# Symbolic frame, clips only record their operations on it
+# and those are applied once the frame is written
+class Frame:
+    def __init__(self, resolution: tuple[int, int], ops: list[tuple] = None):
+        self.resolution = resolution
+        self.ops = ops if ops is not None else []
+
+    def then(self, *op) -> 'Frame':
+        return Frame(self.resolution, self.ops + [op])
+
+def decode(frame: Frame, out: np.ndarray[np.uint8]) -> int:
+    base = -1
+
+    # Video clips cover the whole frame, so only the topmost decodable one is retrieved,
+    # the occluded ones are just advanced to keep their position
+    for i in reversed(range(len(frame.ops))):
+        op, *args = frame.ops[i]
+
+        if op != "decode":
+            continue
+
+        clip, frame_idx = args
+
+        if clip.advance_to(frame_idx) and base == -1 and clip.retrieve(out):
+            base = i
+
+    # The decoded video overwrites the whole buffer, otherwise it has to be cleared
+    if base == -1:
+        out.fill(0)
+
+    return base
+
+def draw(frame: Frame, out: np.ndarray[np.uint8], base: int) -> np.ndarray[np.uint8]:
+    # Everything below the decoded video is covered by it
+    for op, *args in frame.ops[base + 1:]:
+        match op:
+            case "stamp":
+                stamp, (x, y) = args
+                alpha_blit(out, stamp, x, y)
+
+    return out
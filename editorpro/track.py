@@ -1,21 +1,42 @@
 from .clip import *
+from .frame import Frame, decode, draw
 import numpy as np
+from collections import deque
+import bisect
+from concurrent.futures import ThreadPoolExecutor
 from rich.progress import track
 from rich import print
 import tempfile
 
+# ffmpeg encoder options for the fourcc codes that were accepted by cv2.VideoWriter
+_FOURCC_CODECS = {
+    'mp4v': ['-c:v', 'mpeg4', '-q:v', '2', '-pix_fmt', 'yuv420p'],
+    'divx': ['-c:v', 'mpeg4', '-q:v', '2', '-pix_fmt', 'yuv420p'],
+    'dx50': ['-c:v', 'mpeg4', '-q:v', '2', '-pix_fmt', 'yuv420p'],
+    'fmp4': ['-c:v', 'mpeg4', '-q:v', '2', '-pix_fmt', 'yuv420p'],
+    'mpg4': ['-c:v', 'mpeg4', '-q:v', '2', '-pix_fmt', 'yuv420p'],
+    'xvid': ['-c:v', 'mpeg4', '-q:v', '2', '-pix_fmt', 'yuv420p', '-tag:v', 'xvid'],
+    'mjpg': ['-c:v', 'mjpeg', '-q:v', '2', '-pix_fmt', 'yuvj420p'],
+    'avc1': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p'],
+    'h264': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p'],
+    'x264': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p'],
+    'hvc1': ['-c:v', 'libx265', '-pix_fmt', 'yuv420p', '-tag:v', 'hvc1'],
+    'hevc': ['-c:v', 'libx265', '-pix_fmt', 'yuv420p'],
+    'vp09': ['-c:v', 'libvpx-vp9', '-pix_fmt', 'yuv420p']
+}
+
 class Track:
     def __init__(self, index: int, seq: 'Sequence'):
         self.index = index
         self.sequence = seq
+        # Kept sorted by time
         self.clips: list[tuple[int | float, Clip]] = []
+        self._max_end: int | float = 0
 
     @checktypes(None, Clip, (int, float))
     def _insert_clip(self, clip: Clip, time: int | float):
-        self.clips.append((
-            time,
-            clip
-        ))
+        bisect.insort(self.clips, (time, clip), key=lambda x: x[0])
+        self._max_end = max(self._max_end, time + clip.duration)
 
 class VideoTrack(Track):
     @overload
@@ -76,126 +97,185 @@ class Sequence:
         self.audio_tracks.clear()
 
     def calculate_duration(self) -> int | float:
-        duration = 0
+        return max((track._max_end for track in concat(self.audio_tracks, self.video_tracks)), default=0)
+
+    def _audio_graph(self, first_input: int) -> tuple[list[str], str | None]:
+        inputs = []
+        labels = []
+        filters = []
+
+        for audio_track in self.audio_tracks:
+            for time, clip in audio_track.clips:
+                if clip.duration <= 0:
+                    continue
+
+                index = first_input + len(labels)
+                label = f"[a{len(labels)}]"
+                delay = int(time * 1000)
 
-        for track in concat(self.audio_tracks, self.video_tracks):
-            for time, clip in track.clips:
-                if time + clip.duration > duration:
-                    duration = time + clip.duration
+                # Seeking on the input side lets the demuxer skip to the start of the clip
+                inputs += [
+                    '-ss', str(clip.start),
+                    '-to', str(clip.start + clip.duration),
+                    '-i', clip.file
+                ]
+                filters.append(
+                    f"[{index}:a:{clip.audio_stream}]asetpts=PTS-STARTPTS,adelay={delay}:all=1{label}"
+                )
+                labels.append(label)
 
-        return duration
+        if len(labels) == 0:
+            return inputs, None
+
+        filters.append(f"{''.join(labels)}amix=inputs={len(labels)}:duration=longest:normalize=0[out]")
+
+        return inputs, ';'.join(filters)
 
     @checktypes(None, str, str)
     def export(self, file: str, fourcc: str = "mp4v") -> None:
-        temp_video_file = tempfile.mktemp(suffix=".mp4")
+        if fourcc.lower() not in _FOURCC_CODECS:
+            raise ValueError(f"Unsupported fourcc '{fourcc}', expected one of: {', '.join(_FOURCC_CODECS)}")
 
         filename = os.path.basename(file)
-        
-        # Video tracks
-        writer = cv2.VideoWriter(
-            temp_video_file,
-            fourcc=cv2.VideoWriter_fourcc(*fourcc),
-            fps=self.fps,
-            frameSize=self.resolution
-        )
 
         total_seconds = self.calculate_duration()
 
         if total_seconds == 0:
             raise Exception("No clips to render")
 
-        sorted_clips: list[list[tuple[int | float, VideoClip]]] = [None] * len(self.video_tracks)
+        seconds_frame = 1 / self.fps
+        frame_times = np.arange(0, total_seconds, seconds_frame)
+
+        # Only build the frame specs here, nothing is decoded nor drawn yet
+        frames: list[Frame] = [Frame(self.resolution) for _ in frame_times]
 
-        for i, video_track in enumerate(self.video_tracks):
-            sorted_clips[i] = sorted(video_track.clips, key=lambda x: x[0])
+        for video_track in self.video_tracks:
+            clips = video_track.clips
 
-        seconds_frame = 1 / self.fps
-        current_second = 0
-
-        for current_second in track(
-            np.arange(0, total_seconds, seconds_frame),
-            description=f"[green1]Rendering video '{filename}'..[/green1]"
-        ):
-            frame = np.zeros((*self.resolution, 3), dtype=np.uint8)
-
-            for clips in sorted_clips:
-                for time, clip in clips:
-                    if current_second >= time:
-                        if current_second <= time + clip.duration:
-                            frame = clip.render(frame, round((current_second - time) * self.fps))
-                    
-                    # Sorted by time, so if the current time is greater than the time of the clip
-                    # All other clips are also greater than the current time
-                    else:
-                        break
-                        
-            writer.write(frame)
-
-        writer.release()
-
-        # Audio tracks
-        sorted_clips: list[list[tuple[int | float, AudioClip]]] = [None] * len(self.audio_tracks)
-
-        for i, audio_track in enumerate(self.audio_tracks):
-            sorted_clips[i] = sorted(audio_track.clips, key=lambda x: x[0])
-
-        from moviepy.editor import AudioFileClip, concatenate_audioclips, CompositeAudioClip
-
-        final_audios = []
-        for clips in sorted_clips:
             if len(clips) == 0:
                 continue
-            
-            audios = []
 
-            first_time, clip = clips.pop(0)
-            audios.append(
-                AudioFileClip(clip.file).subclip(clip.start, clip.start + clip.duration)
-            )
+            starts = np.asarray([time for time, _ in clips], dtype=np.float64)
+            ends = np.asarray([time + clip.duration for time, clip in clips], dtype=np.float64)
+
+            # Last clip that started before each frame
+            indices = np.searchsorted(starts, frame_times, side='right') - 1
+
+            # Latest end of all clips started so far, a frame is active if any of them is still running
+            max_ends = np.maximum.accumulate(ends)
+            active = (indices >= 0) & (frame_times <= max_ends[indices])
+
+            if not np.any(starts[1:] < max_ends[:-1]):
+                # No overlapping clips, the last started clip is the only one that can be active
+                for i in np.flatnonzero(active):
+                    time, clip = clips[indices[i]]
+                    frames[i] = clip.render(frames[i], float(frame_times[i] - time))
 
-            for i, (time, clip) in enumerate(clips):
-                if i == 0:
-                    silence_length = time - (first_time + clip.duration)
+                continue
+
+            for i in np.flatnonzero(active):
+                current_second = frame_times[i]
+                running = []
 
-                else:
-                    silence_length = time - (clips[i - 1][0] + clips[i - 1][1].duration)
+                # Walk back while an earlier clip could still be running
+                j = indices[i]
+                while j >= 0 and max_ends[j] >= current_second:
+                    if ends[j] >= current_second:
+                        running.append(j)
 
-                if silence_length > 0:
-                    audios.append(create_silence(silence_length))
+                    j -= 1
 
-                audios.append(AudioFileClip(clip.file).subclip(clip.start, clip.start + clip.duration))
+                # Rendered in start time order, like the clips were inserted
+                for j in reversed(running):
+                    time, clip = clips[j]
+                    frames[i] = clip.render(frames[i], float(current_second - time))
 
-            final_audios.append(concatenate_audioclips(audios))
+        # Video frames are piped raw to ffmpeg, which also mixes the audio tracks in the same pass
+        w, h = self.resolution
+        audio_inputs, audio_filter = self._audio_graph(first_input=1)
 
-        if len(final_audios) == 0:
-            subprocess.run([
-                'ffmpeg',
-                '-i', temp_video_file,
-                '-c:v', 'copy',
-                '-an',
-                '-y',
-                file
-            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if audio_filter is None:
+            audio_args = ['-an']
 
         else:
-            temp_audio_file = tempfile.mktemp(suffix=".mp3")
-            
-            final_audio = CompositeAudioClip(final_audios)
-            final_audio.write_audiofile(temp_audio_file, fps=44100)
-
-            subprocess.run([
-                'ffmpeg',
-                '-i', temp_video_file,
-                '-i', temp_audio_file,
-                '-c:v', 'copy',
-                '-c:a', 'aac',
-                '-y',
-                '-strict', 'experimental',
-                file
-            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-            os.remove(temp_audio_file)
-        
-        os.remove(temp_video_file)
+            audio_args = [
+                '-filter_complex', audio_filter,
+                '-map', '[out]',
+                '-c:a', 'aac'
+            ]
+
+        # Only errors are logged, kept in a file so the pipe can't fill up while frames are written
+        stderr = tempfile.TemporaryFile()
+
+        proc = subprocess.Popen([
+            'ffmpeg',
+            '-loglevel', 'error',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-s', f'{w}x{h}',
+            '-r', str(self.fps),
+            '-i', 'pipe:',
+            *audio_inputs,
+            '-map', '0:v',
+            *audio_args,
+            *_FOURCC_CODECS[fourcc.lower()],
+            '-y',
+            file
+        ], stdin=subprocess.PIPE, bufsize=max(1 << 20, w * h * 3 * 4), stdout=subprocess.DEVNULL, stderr=stderr)
+
+        def write(frame: np.ndarray[np.uint8]) -> None:
+            # The buffers are contiguous, so the pipe reads them without a bytes copy
+            proc.stdin.write(memoryview(frame).cast('B'))
+
+        # Captures have to be read in order, so frames are decoded here
+        # and the rest of the drawing runs in the pool, written back in order
+        # Only the overlays are drawn in the pool, more workers would just hold more frames in memory
+        workers = min(os.cpu_count() or 1, 8)
+        ahead = 2 * workers
+
+        # Reused in a ring, numpy arrays are (height, width)
+        buffers = [
+            np.zeros((h, w, 3), dtype=np.uint8)
+            for _ in range(ahead)
+        ]
+        futures = deque()
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for i, frame in enumerate(track(
+                    frames,
+                    description=f"[green1]Rendering video '{filename}'..[/green1]"
+                )):
+                    # Frees the buffer of the frame rendered 'ahead' frames ago
+                    if len(futures) >= ahead:
+                        write(futures.popleft().result())
+
+                    out = buffers[i % ahead]
+                    base = decode(frame, out)
+
+                    futures.append(pool.submit(draw, frame, out, base))
+
+                while futures:
+                    write(futures.popleft().result())
+
+        # ffmpeg exited early, its error is reported below
+        except BrokenPipeError:
+            pass
+
+        finally:
+            try:
+                proc.stdin.close()
+
+            except BrokenPipeError:
+                pass
+
+            proc.wait()
+
+            stderr.seek(0)
+            error = stderr.read().decode(errors='replace').strip()
+            stderr.close()
+
+        if proc.returncode != 0:
+            raise Exception(f"ffmpeg failed to encode '{file}' (exit code {proc.returncode}): {error}")
 
         print(f"[green1]Successfully rendered video in '{file}'[/green1]")
\ No newline at end of file
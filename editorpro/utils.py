@@ -1,14 +1,26 @@
 from typing import Type, Tuple, Iterable
 from functools import wraps
-from moviepy.editor import AudioClip
 
 def rgb_to_bgr(rgb):
-    return (rgb[2], rgb[1], rgb[0])
+    return rgb[2::-1]
 
 def hex_to_rgb(value):
-    value = value.lstrip('#')
-    lv = len(value)
-    return tuple(int(value[i:i + lv // 3], 16) for i in range(0, lv, lv // 3))
+    digits = value.lstrip('#')
+
+    # Shorthand like #f00
+    if len(digits) == 3:
+        digits = ''.join(c * 2 for c in digits)
+
+    try:
+        b = bytes.fromhex(digits)
+
+    except ValueError:
+        raise ValueError(f"Invalid hex color {value}.") from None
+
+    if len(b) != 3:
+        raise ValueError(f"Invalid hex color {value}.")
+
+    return (b[0], b[1], b[2])
 
 def rgb_to_hex(rgb):
     return '#%02x%02x%02x' % rgb
@@ -18,24 +30,31 @@ def concat(*args: Iterable):
         for item in arg:
             yield item
 
-def create_silence(duration):
-    return AudioClip(lambda t: (0, 0), duration=duration)
-
 def checktypes(*expected_types: Tuple[Type] | Type | None, allow_none: bool = False):
     def decorator(func):
+        # Type checks are skipped entirely with python -O
+        if not __debug__:
+            return func
+
+        # Resolved once, the wrapper only runs the isinstance calls
+        checks = tuple(
+            (i, expected_type) for i, expected_type in enumerate(expected_types)
+            if expected_type is not None
+        )
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            for arg, expected_type in zip(args, expected_types):
-                
-                if (
-                    expected_type is not None and
-                    not (allow_none and arg is None) and 
-                    not isinstance(arg, expected_type)
-                ):
+            for i, expected_type in checks:
+                if i >= len(args):
+                    break
+
+                arg = args[i]
+
+                if not isinstance(arg, expected_type) and not (allow_none and arg is None):
                     raise TypeError(f"Expected {expected_type}, but got {type(arg).__name__} for argument {arg}.")
             
             return func(*args, **kwargs)
     
         return wrapper
     
-    return decorator
\ No newline at end of file
+    return decorator